@@ -30,23 +30,33 @@
 # Libraries and instantiations of libraries
 ######################
 import boto3
+import botocore.waiter
+import jmespath
+from botocore.config import Config
+from botocore.exceptions import WaiterError
 import time
 import os
+import random
+import functools
+from collections import namedtuple
 import logging
 # For CLI Parsing of args
 from optparse import OptionParser
+# For running independent AWS waits/calls at the same time
+from concurrent.futures import ThreadPoolExecutor
 # This is for the pre/post external health check feature
-from subprocess import call
-try:
-    elb = boto3.client('elb')
-    autoscaling = boto3.client('autoscaling')
-    ec2 = boto3.client('ec2')
-    elbv2 = boto3.client('elbv2')
-except:
-    elb = boto3.client('elb', region_name='eu-west-1')
-    autoscaling = boto3.client('autoscaling', region_name='eu-west-1')
-    ec2 = boto3.client('ec2', region_name='eu-west-1')
-    elbv2 = boto3.client('elbv2', region_name='eu-west-1')
+import subprocess
+import shlex
+import shutil
+import re
+# Adaptive retries back off client-side as soon as AWS starts throttling us, and the larger
+# connection pool lets our concurrent waits share each client
+boto_config = Config(retries={'max_attempts': 10, 'mode': 'adaptive'}, max_pool_connections=50)
+session = boto3.session.Session()
+elb = session.client('elb', config=boto_config)
+autoscaling = session.client('autoscaling', config=boto_config)
+ec2 = session.client('ec2', config=boto_config)
+elbv2 = session.client('elbv2', config=boto_config)
 
 
 LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
@@ -54,6 +64,56 @@ logging.basicConfig(level=LOG_LEVEL, format='%(levelname)s: %(asctime)s: %(messa
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
+# How often (seconds) and how many times our waiters poll AWS before giving up
+WAITER_CONFIG = {'Delay': 10, 'MaxAttempts': 360}
+
+# The shortest interval (seconds) we poll the autoscaling API at, it is slow to converge and throttles
+# aggressively so polling it any faster only wastes Describe calls
+AUTOSCALING_MIN_POLL_SECONDS = 15
+
+# How long (seconds) we keep re-trying the external health up check before giving up
+EXTERNAL_HEALTH_CHECK_MAX_SECONDS = 3600
+
+# Commands containing any of these need a real shell to mean what the user meant, anything else we run directly
+SHELL_METACHARACTERS = frozenset("|&;<>()$`\\*?[]#~=%!{}\n")
+
+# The placeholders we string replace into external commands, see get_instance_substitutions
+INSTANCE_PLACEHOLDERS = re.compile(r"(?:NEW|OLD)_INSTANCE_(?:PRIVATE_IP_ADDRESS|PUBLIC_IP_ADDRESS|ID)")
+
+# What we consider a healthy autoscaler instance, shared by the waiter below and get_autoscaler_healthy_instances
+HEALTHY_INSTANCES_FILTER = "Instances[?HealthStatus=='Healthy' && LifecycleState=='InService']"
+
+# Pre-compiled query we run against Describe responses on every poll
+HEALTHY_AUTOSCALER_INSTANCES = jmespath.compile(HEALTHY_INSTANCES_FILTER)
+
+# Custom waiter for autoscaling (boto3 does not ship one) that succeeds once the
+# number of healthy, in-service instances equals the desired capacity
+autoscaling_waiter_model = botocore.waiter.WaiterModel({
+    'version': 2,
+    'waiters': {
+        'GroupHasHealthyDesiredCapacity': {
+            'operation': 'DescribeAutoScalingGroups',
+            'delay': AUTOSCALING_MIN_POLL_SECONDS,
+            'maxAttempts': 240,
+            'acceptors': [
+                {
+                    'matcher': 'path',
+                    'argument': "length(AutoScalingGroups[0]." + HEALTHY_INSTANCES_FILTER + ") == AutoScalingGroups[0].DesiredCapacity",
+                    'expected': True,
+                    'state': 'success'
+                }
+            ]
+        }
+    }
+})
+autoscaling_healthy_desired_capacity_waiter = botocore.waiter.create_waiter_with_client('GroupHasHealthyDesiredCapacity', autoscaling_waiter_model, autoscaling)
+
+# The stock waiters we use, built once up front and shared (like our clients) instead of on every wait
+elb_instance_in_service_waiter = elb.get_waiter('instance_in_service')
+elb_instance_deregistered_waiter = elb.get_waiter('instance_deregistered')
+elbv2_target_in_service_waiter = elbv2.get_waiter('target_in_service')
+elbv2_target_deregistered_waiter = elbv2.get_waiter('target_deregistered')
+
 ######################
 # CLI Argument handling
 ######################
@@ -91,8 +151,30 @@ parser.add_option("-b", "--run-before-server-going-down-command",
 parser.add_option("-d", "--run-after-server-going-down-command",
                   dest="runafterserverdowncommand",
                   default="",
-                  help="An external command to run before a server goes down, this is run BEFORE the wait-for-seconds.  This should be a valid 'shell' command that can run on this server.  This command supports _simple_ templating in the form of string replacing OLD_INSTANCE_ID, OLD_INSTANCE_PRIVATE_IP_ADDRESS, OLD_INSTANCE_PUBLIC_IP_ADDRESS.  Often used to do stuff like pull a server out of a cluster (eg: to force-leave Consul).  This command MUST return a retval of 0 otherwise this deployment will halt.",
+                  help="An external command to run after a server has been sent the terminate command.  This should be a valid 'shell' command that can run on this server.  This command supports _simple_ templating in the form of string replacing OLD_INSTANCE_ID, OLD_INSTANCE_PRIVATE_IP_ADDRESS, OLD_INSTANCE_PUBLIC_IP_ADDRESS.  Often used to do stuff like pull a server out of a custom monitoring system (eg: Zabbix/Nagios).  A non-zero retval is only logged as a warning.",
                   metavar="command")
+parser.add_option("-g", "--run-after-server-going-down-command-in-background",
+                  dest="runafterserverdowncommandinbackground",
+                  action="store_true",
+                  help="Run the --run-after-server-going-down-command in the background while the next server is rolled, instead of waiting for it.  It may then run at the same time as the next server's --run-before-server-going-down-command (these after commands still run one at a time, in order, and are all finished before this script exits)")
+parser.add_option("-t", "--command-timeout",
+                  dest="commandtimeout",
+                  default="300",
+                  type="int",
+                  help="The number of seconds a --check-if-new-server-is-up-command may run before it is killed and considered failed (300 by default).  The server down commands are never killed",
+                  metavar="seconds")
+parser.add_option("-p", "--poll-interval",
+                  dest="pollinterval",
+                  default="2",
+                  type="float",
+                  help="The number of seconds to wait before re-running a failed --check-if-new-server-is-up-command, this grows with every check up to --max-poll-interval (2 by default).  Checks against the autoscaler grow the same way but never go below 15, load balancer checks always run every 10",
+                  metavar="seconds")
+parser.add_option("-m", "--max-poll-interval",
+                  dest="maxpollinterval",
+                  default="30",
+                  type="float",
+                  help="The most number of seconds to wait in-between re-running a failed --check-if-new-server-is-up-command or re-checking the autoscaler (30 by default)",
+                  metavar="seconds")
 parser.add_option("-c", "--check-if-instances-need-to-be-terminated",
                   dest="checkifinstancesneedtobeterminated",
                   action="store_true",
@@ -104,6 +186,10 @@ if options.autoscaler == "":
     logger.info("ERROR: You MUST specify the autoscaler with -a")
     parser.print_usage()
     exit(1)
+if options.pollinterval <= 0 or options.maxpollinterval < options.pollinterval:
+    logger.info("ERROR: --poll-interval must be above zero and no larger than --max-poll-interval")
+    parser.print_usage()
+    exit(1)
 if options.force:
     logger.info("ALERT: We are force-deploying this autoscaler, which may cause downtime under some circumstances")
 if options.skip:
@@ -115,24 +201,76 @@ if options.skip:
 ######################
 
 
-# Get a load balancer
-def get_load_balancer(loadbalancer_name):
-    try:
-        fetched_data = elb.describe_load_balancers(
-            LoadBalancerNames=[
-                loadbalancer_name,
-            ],
-            PageSize=1
-        )
+# What the autoscaler we are rolling is attached to, resolved once up front since it doesn't change mid-rollout
+RolloutContext = namedtuple('RolloutContext', ['lb_names', 'tg_arns'])
 
-        if len(fetched_data['LoadBalancerDescriptions']) > 0:
-            return fetched_data['LoadBalancerDescriptions'][0]
-    except Exception as e:
-        raise Exception("Error searching for loadbalancer with name [{}]".format(loadbalancer_name), e)
-    raise Exception("No loadbalancer found with name [{}]".format(loadbalancer_name))
+
+# Run each (function, arg, ...) task at the same time and return their results in order,
+# boto3 clients are thread-safe so these can share our module-level clients
+def run_concurrently( tasks ):
+    if len(tasks) == 0:
+        return []
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        futures = [executor.submit(*task) for task in tasks]
+        return [future.result() for future in futures]
+
+
+# Yield how long to sleep in-between checks of something we are waiting on, starting at initial and
+# growing by factor up to maximum, each one +/- jitter (a fraction) so we don't poll in lockstep
+def backoff(initial, maximum, factor=1.5, jitter=0.1):
+    delay = initial
+    while True:
+        yield delay * random.uniform(1 - jitter, 1 + jitter)
+        delay = min(delay * factor, maximum)
+
+
+# Poll the autoscaling API no faster than AUTOSCALING_MIN_POLL_SECONDS
+def autoscaling_backoff():
+    return backoff(max(options.pollinterval, AUTOSCALING_MIN_POLL_SECONDS), max(options.maxpollinterval, AUTOSCALING_MIN_POLL_SECONDS))
+
+
+# Call check until it returns something (truthy), sleeping for each of delays in-between, and return that.
+# Gives up and returns None if it would take longer than timeout seconds (if given)
+def poll( check, delays, waiting_message, timeout=None ):
+    give_up_at = None if timeout is None else time.time() + timeout
+    for delay in delays:
+        result = check()
+        if result:
+            return result
+        if give_up_at is not None and time.time() + delay > give_up_at:
+            return None
+        logger.info("%s, checking again in %.1f seconds...", waiting_message, delay)
+        time.sleep(delay)
+
+
+# Memoize the results of a Describe call for ttl seconds, since most of what we describe
+# doesn't change mid-rollout.  Use invalidate_cache() after changing anything on AWS
+cached_functions = []
+def ttl_cache(ttl):
+    def decorator(function):
+        cache = {}
+        @functools.wraps(function)
+        def wrapper(*args):
+            now = time.time()
+            if args in cache and now - cache[args][0] < ttl:
+                return cache[args][1]
+            result = function(*args)
+            cache[args] = (now, result)
+            return result
+        wrapper.cache = cache
+        cached_functions.append(wrapper)
+        return wrapper
+    return decorator
+
+
+# Forget everything we have cached, called after any of our mutating API calls
+def invalidate_cache():
+    for function in cached_functions:
+        function.cache.clear()
 
 
 # Get a application load balancer
+@ttl_cache(ttl=120)
 def get_application_load_balancer( loadbalancer_name ):
     try:
         fetched_data = elbv2.describe_load_balancers(
@@ -143,10 +281,11 @@ def get_application_load_balancer( loadbalancer_name ):
         if len(fetched_data['LoadBalancers']) > 0:
             return fetched_data['LoadBalancers'][0]
     except Exception as e:
-        raise Exception("Error searching for loadbalancer with name [{}]".format(loadbalancer_name), e)
-    raise Exception("No loadbalancer found with name [{}]".format(loadbalancer_name))
+        raise Exception(f"Error searching for loadbalancer with name [{loadbalancer_name}]", e)
+    raise Exception(f"No loadbalancer found with name [{loadbalancer_name}]")
 
 # Describe launch configuration
+@ttl_cache(ttl=120)
 def describe_launch_configuration( launch_configuration_name ):
     try:
         fetched_data = autoscaling.describe_launch_configurations(
@@ -157,8 +296,8 @@ def describe_launch_configuration( launch_configuration_name ):
         if len(fetched_data['LaunchConfigurations']) > 0:
             return fetched_data['LaunchConfigurations'][0]
     except Exception as e:
-        raise Exception("Error searching for launch configuration with name [{}]".format(launch_configuration_name), e)
-    raise Exception("No launch configuration found with name [{}]".format(launch_configuration_name))
+        raise Exception(f"Error searching for launch configuration with name [{launch_configuration_name}]", e)
+    raise Exception(f"No launch configuration found with name [{launch_configuration_name}]")
 
 # Update auto scaling group max size
 def update_auto_scaling_group_max_size( autoscaling_group_name, max_size ):
@@ -166,13 +305,15 @@ def update_auto_scaling_group_max_size( autoscaling_group_name, max_size ):
         AutoScalingGroupName=autoscaling_group_name,
         MaxSize=max_size
     )
+    invalidate_cache()
     if response['ResponseMetadata']['HTTPStatusCode'] == 200:
         return True
     else:
-        logger.info("ERROR: Unable to set max autoscaling group size on '" + autoscaling_group_name + "'")
+        logger.info("ERROR: Unable to set max autoscaling group size on '%s'", autoscaling_group_name)
         return False
 
 # Get target group
+@ttl_cache(ttl=120)
 def get_target_group( target_group_name ):
     try:
         fetched_data = elbv2.describe_target_groups(
@@ -184,12 +325,18 @@ def get_target_group( target_group_name ):
         if len(fetched_data['TargetGroups']) > 0:
             return fetched_data['TargetGroups'][0]
     except Exception as e:
-        raise Exception("Error searching for target group with name [{}]".format(target_group_name), e)
-    raise Exception("No target group found with name [{}]".format(target_group_name))
+        raise Exception(f"Error searching for target group with name [{target_group_name}]", e)
+    raise Exception(f"No target group found with name [{target_group_name}]")
 
 
-# Get a autoscaling group
+# Get a autoscaling group, cached (see describe_autoscaling_group for a fresh copy)
+@ttl_cache(ttl=5)
 def get_autoscaling_group( autoscaling_group_name ):
+    return describe_autoscaling_group( autoscaling_group_name )
+
+
+# Get a autoscaling group straight from the API, for when we are waiting for it to change
+def describe_autoscaling_group( autoscaling_group_name ):
     try:
         fetched_data = autoscaling.describe_auto_scaling_groups(
             AutoScalingGroupNames=[
@@ -200,22 +347,21 @@ def get_autoscaling_group( autoscaling_group_name ):
         if len(fetched_data['AutoScalingGroups']) > 0:
             return fetched_data['AutoScalingGroups'][0]
     except Exception as e:
-        raise Exception("Error searching for autoscaling group with name [{}]".format(autoscaling_group_name), e)
-    raise Exception("Error searching for autoscaling group with name [{}]".format(autoscaling_group_name))
+        raise Exception(f"Error searching for autoscaling group with name [{autoscaling_group_name}]", e)
+    raise Exception(f"Error searching for autoscaling group with name [{autoscaling_group_name}]")
 
 
-# Get all autoscaling groups
+# Get all autoscaling groups, page by page so we don't stop at the first 100
+@ttl_cache(ttl=60)
 def get_all_autoscaling_groups( ):
     try:
-        fetched_data = autoscaling.describe_auto_scaling_groups(
-            MaxRecords=100
-        )
-
-        if AutoScalingGroups in fetched_data:
-            return fetched_data['AutoScalingGroups']
+        output = []
+        paginator = autoscaling.get_paginator('describe_auto_scaling_groups')
+        for page in paginator.paginate(PaginationConfig={'PageSize': 100}):
+            output.extend(page['AutoScalingGroups'])
+        return output
     except Exception as e:
         raise Exception("Error getting all autoscaling groups", e)
-    raise Exception("Error getting all autoscaling groups")
 
 
 # Get autoscaling group configuration
@@ -227,7 +373,7 @@ def get_autoscaling_group_configuration(autoscaler):
             configuration = configuration['LaunchTemplate']['LaunchTemplateSpecification']['LaunchTemplateName']
         else:
             raise Exception(
-                "Error searching configuration for autoscaling group with name [{}]".format(autoscaler['AutoScalingGroupName']))
+                f"Error searching configuration for autoscaling group with name [{autoscaler['AutoScalingGroupName']}]")
     return configuration
 
 
@@ -240,41 +386,34 @@ def get_instance_configuration(instance):
             configuration = configuration['LaunchTemplateName']
         else:
             raise Exception(
-                "Error searching configuration for instance with id [{}]".format(instance['InstanceId']))
+                f"Error searching configuration for instance with id [{instance['InstanceId']}]")
     return configuration
 
 
 # Return a list of instances to skip
 def get_instances_to_skip(instances, autoscaler):
-    output = []
-
-    for instance in instances:
-        if get_autoscaling_group_configuration(autoscaler) == get_instance_configuration(instance):
-            output.append(instance)
+    autoscaler_configuration = get_autoscaling_group_configuration(autoscaler)
+    return [instance for instance in instances if get_instance_configuration(instance) == autoscaler_configuration]
 
-    return output
-
-
-# Gets the suspended processes for an autoscaling group (by name or predefined to save API calls)
-def get_suspended_processes( autoscaling_group_name_or_definition ):
-    if type(autoscaling_group_name_or_definition) is str:
-        autoscaling_group = get_autoscaling_group( autoscaling_group_name_or_definition )
-    else:
-        autoscaling_group = autoscaling_group_name_or_definition
 
+# Gets the suspended processes from an autoscaling group definition
+def get_suspended_processes( autoscaling_group ):
     output = []
     for item in autoscaling_group['SuspendedProcesses']:
         output.append(item['ProcessName'])
 
     return output
 
-# Gets an single instance's details
-def describe_instance(instance_id):
-    # Get detailed instance information from the instances attached to the autoscaler
-    instances = ec2.describe_instances(InstanceIds=[instance_id])
-    for reservation in instances["Reservations"]:
-        for instance in reservation["Instances"]:
-            return instance
+# Gets many instances' details with as few API calls as possible, keyed by instance id
+def describe_instances_bulk(instance_ids, chunk_size=100):
+    instance_ids = list(instance_ids)
+    output = {}
+    for start in range(0, len(instance_ids), chunk_size):
+        instances = ec2.describe_instances(InstanceIds=instance_ids[start:start + chunk_size])
+        for reservation in instances["Reservations"]:
+            for instance in reservation["Instances"]:
+                output[instance['InstanceId']] = instance
+    return output
 
 
 # Gets the suspended processes for an autoscaling group (by name or predefined to save API calls)
@@ -283,10 +422,11 @@ def suspend_processes( autoscaling_group_name, processes_to_suspend ):
         AutoScalingGroupName=autoscaling_group_name,
         ScalingProcesses=processes_to_suspend
     )
+    invalidate_cache()
     if response['ResponseMetadata']['HTTPStatusCode'] == 200:
         return True
     else:
-        logger.info("ERROR: Unable to suspend_processes on '" + autoscaling_group_name + "'")
+        logger.info("ERROR: Unable to suspend_processes on '%s'", autoscaling_group_name)
         return False
 
 
@@ -296,10 +436,11 @@ def resume_processes( autoscaling_group_name, processes_to_resume ):
         AutoScalingGroupName=autoscaling_group_name,
         ScalingProcesses=processes_to_resume
     )
+    invalidate_cache()
     if response['ResponseMetadata']['HTTPStatusCode'] == 200:
         return True
     else:
-        logger.info("ERROR: Unable to resume_processes on '" + autoscaling_group_name + "'")
+        logger.info("ERROR: Unable to resume_processes on '%s'", autoscaling_group_name)
         return False
 
 
@@ -307,405 +448,381 @@ def resume_all_processes( autoscaling_group_name ):
     response = autoscaling.resume_processes(
         AutoScalingGroupName=autoscaling_group_name
     )
+    invalidate_cache()
     if response['ResponseMetadata']['HTTPStatusCode'] == 200:
         return True
     else:
-        logger.info("ERROR: Unable to resume_all_processes on '" + autoscaling_group_name + "'")
+        logger.info("ERROR: Unable to resume_all_processes on '%s'", autoscaling_group_name)
         return False
 
 
-# Check if an autoscaler is currently performing a scaling activity
-def check_if_autoscaler_is_scaling( autoscaling_group_name ):
-    # Get the autoscaling group
-    autoscaler = autoscaling.describe_auto_scaling_groups(
-        AutoScalingGroupNames=[
-            autoscaling_group_name,
-        ],
-        MaxRecords=1
-    )
-
-    # Quick error checking
-    if len(autoscaler['AutoScalingGroups']) != 1:
-        logger.info("ERROR: Unable to get describe autoscaling group: " + autoscaling_group_name)
-        exit(1)
-    autoscaler = autoscaler['AutoScalingGroups'][0]
-
-    # Check if our healthy instance count matches our desired capacity
-    healthy_instance_count = get_number_of_autoscaler_healthy_instances( autoscaler )
-    if healthy_instance_count != autoscaler['DesiredCapacity']:
-        logger.info("INFO: Our autoscaler must be scaling, desired " + str(autoscaler['DesiredCapacity']) + ", healthy instances " + str(healthy_instance_count))
-        return True
-
-    return False
-
-
-def deregister_instance_from_load_balancer( instance_id, loadbalancer_name ):
+# Deregister a batch of instances from a load balancer in a single API call
+def deregister_instances_from_load_balancer( instance_ids, loadbalancer_name ):
     response = elb.deregister_instances_from_load_balancer(
         LoadBalancerName=loadbalancer_name,
-        Instances=[
-            {
-                'InstanceId': instance_id
-            },
-        ]
+        Instances=[{'InstanceId': instance_id} for instance_id in instance_ids]
     )
+    invalidate_cache()
     if response['ResponseMetadata']['HTTPStatusCode'] == 200:
         return True
     else:
-        logger.info("ERROR: Unable to deregister instance '" + instance_id + "' from load balancer '" + loadbalancer_name + "'")
+        logger.info("ERROR: Unable to deregister instances %s from load balancer '%s'", instance_ids, loadbalancer_name)
         return False
 
 
-def deregister_instance_from_target_group( instance_id, target_group_arn ):
+# Deregister a batch of instances from a target group in a single API call
+def deregister_instances_from_target_group( instance_ids, target_group_arn ):
     response = elbv2.deregister_targets(
         TargetGroupArn=target_group_arn,
-        Targets=[
-            {
-                'Id': instance_id,
-            },
-        ]
+        Targets=[{'Id': instance_id} for instance_id in instance_ids]
     )
+    invalidate_cache()
     if response['ResponseMetadata']['HTTPStatusCode'] == 200:
         return True
     else:
-        logger.info("ERROR: Unable to deregister instance '" + instance_id + "' from load balancer '" + loadbalancer_name + "'")
+        logger.info("ERROR: Unable to deregister instances %s from target group '%s'", instance_ids, target_group_arn)
         return False
 
 
-def wait_for_autoscaler_to_have_healthy_desired_instances( autoscaling_group_name_or_definition ):
-    if type(autoscaling_group_name_or_definition) is str:
-        autoscaler_description = get_autoscaling_group( autoscaling_group_name_or_definition )
-    else:
-        autoscaler_description = autoscaling_group_name_or_definition
-    # Get our desired capacity
-    desired_capacity = int(autoscaler_description['DesiredCapacity'])
-
-    while True:
-        healthy_instance_count = int(get_number_of_autoscaler_healthy_instances( autoscaler_description['AutoScalingGroupName'] ))
-        if desired_capacity != healthy_instance_count:
-            logger.info("WARNING: We have " + str(healthy_instance_count) + " healthy instances on the autoscaler but we want " + str(desired_capacity))
-        elif check_if_autoscaler_is_scaling( autoscaler_description['AutoScalingGroupName'] ):
-            logger.info("WARNING: We are currently performing some autoscaling, we should wait...")
-        else:
-            logger.info("SUCCESS: We currently have desired capacity of " + str(desired_capacity) + " on this autoscaler")
-            break
-        logger.info("Waiting for 5 seconds...")
-        time.sleep(5)
-
-
-# Get the number of healthy instances from the autoscaling group definition
-def get_number_of_autoscaler_healthy_instances( autoscaler_description ):
-    return len(get_autoscaler_healthy_instances( autoscaler_description ))
-
+def wait_for_autoscaler_to_have_healthy_desired_instances( autoscaling_group_name ):
+    logger.info("Waiting for the healthy instances on %s to match its desired capacity...", autoscaling_group_name)
+    try:
+        autoscaling_healthy_desired_capacity_waiter.wait(
+            AutoScalingGroupNames=[
+                autoscaling_group_name,
+            ],
+            MaxRecords=1
+        )
+    except WaiterError as e:
+        logger.info("ERROR: Failed waiting for healthy instances to match desired capacity on '%s': %s", autoscaling_group_name, e)
+        exit(1)
+    logger.info("SUCCESS: We currently have our desired capacity of healthy instances on this autoscaler")
 
-# Get the healthy instances from the autoscaling group definition or name
-def get_autoscaler_healthy_instances( autoscaling_group_name_or_definition ):
-    if type(autoscaling_group_name_or_definition) is str:
-        autoscaler_description = get_autoscaling_group( autoscaling_group_name_or_definition )
-    else:
-        autoscaler_description = autoscaling_group_name_or_definition
 
-    healthy_instances = []
-    for instance in autoscaler_description['Instances']:
-        if instance['HealthStatus'] == 'Healthy':
-            healthy_instances.append(instance)
-    return healthy_instances
+# Get the healthy instances from the autoscaling group definition
+def get_autoscaler_healthy_instances( autoscaler_description ):
+    return HEALTHY_AUTOSCALER_INSTANCES.search(autoscaler_description)
 
 
 def terminate_instance_in_auto_scaling_group( instance_id, autoscaling_group_name, decrement_capacity=False ):
-    logger.info("Terminating instance '" + instance_id + "' from the autoscaling group '" + autoscaling_group_name + "'...")
-
-    if decrement_capacity is True:
-        response = autoscaling.terminate_instance_in_auto_scaling_group(
-            InstanceId=instance_id,
-            ShouldDecrementDesiredCapacity=True
-        )
-    else:
-        response = autoscaling.terminate_instance_in_auto_scaling_group(
-            InstanceId=instance_id,
-            ShouldDecrementDesiredCapacity=False
-        )
+    logger.info("Terminating instance '%s' from the autoscaling group '%s'...", instance_id, autoscaling_group_name)
 
+    response = autoscaling.terminate_instance_in_auto_scaling_group(
+        InstanceId=instance_id,
+        ShouldDecrementDesiredCapacity=(decrement_capacity is True)
+    )
+    invalidate_cache()
     if response['ResponseMetadata']['HTTPStatusCode'] == 200:
         logger.info("Executed okay")
         return True
     else:
-        logger.info("ERROR: Unable to detach autoscaler '" + autoscaling_group_name + "' from the load balancer '" + loadbalancer_name)
+        logger.info("ERROR: Unable to terminate instance '%s' in the autoscaling group '%s'", instance_id, autoscaling_group_name)
         exit(1)
 
 
 def set_desired_capacity( autoscaling_group_name, desired_capacity ):
-    logger.info("Setting desired capacity of '" + autoscaling_group_name + "' to '" + str(desired_capacity) + "'...")
+    logger.info("Setting desired capacity of '%s' to '%s'...", autoscaling_group_name, desired_capacity)
     response = autoscaling.set_desired_capacity(
         AutoScalingGroupName=autoscaling_group_name,
         DesiredCapacity=desired_capacity,
         HonorCooldown=False
     )
+    invalidate_cache()
 
     # Check if this executed okay...
     if response['ResponseMetadata']['HTTPStatusCode'] == 200:
         logger.info("Executed okay")
         return True
     else:
-        logger.info("ERROR: Unable to set_desired_capacity on '" + autoscaling_group_name + "'")
+        logger.info("ERROR: Unable to set_desired_capacity on '%s'", autoscaling_group_name)
         exit(1)
 
 
-def get_instance_ids_of_target_group( target_group_arn ):
-
-    response = elbv2.describe_target_health(
-        TargetGroupArn=target_group_arn
-    )
+# Get our healthy instances from the autoscaler we were handed, only going back to the API for a
+# fresh copy if it is short of healthy instances.  Used by the load balancer/target group attachment waits
+def get_healthy_instances_to_wait_for( autoscaler ):
+    as_instances = get_autoscaler_healthy_instances( autoscaler )
+    if len(as_instances) < autoscaler['DesiredCapacity']:
+        logger.info("Getting healthy instances on our autoscaler")
+        autoscaler = describe_autoscaling_group( autoscaler['AutoScalingGroupName'] )
+        as_instances = get_autoscaler_healthy_instances( autoscaler )
+    if len(as_instances) != autoscaler['DesiredCapacity']:
+        logger.info("WARNING - We have %s healthy instances on the ASG but desired instances is set to %s", len(as_instances), autoscaler['DesiredCapacity'])
+    return as_instances
 
-    output = []
-    for target in response['TargetHealthDescriptions']:
-        output.append(target['Target']['Id'])
-    return output
 
+def wait_for_complete_targetgroup_autoscaler_attachment( target_group_arn, autoscaler ):
 
-def get_instance_ids_of_load_balancer( loadbalancer_name_or_definition ):
-    if type(loadbalancer_name_or_definition) is str:
-        loadbalancer = get_load_balancer( loadbalancer_name_or_definition )
-    else:
-        loadbalancer = loadbalancer_name_or_definition
+    logger.info("Waiting for attachment of autoscaler %s to target_group_arn: %s", autoscaler['AutoScalingGroupName'], target_group_arn)
 
-    output = []
-    for instance in loadbalancer['Instances']:
-        output.append(instance['InstanceId'])
-    return output
+    as_instances = get_healthy_instances_to_wait_for( autoscaler )
 
+    # Nothing to wait for, and the waiter would check every instance attached instead
+    if len(as_instances) == 0:
+        logger.info("No healthy instances on the ASG to wait for")
+        return
 
-def wait_for_complete_targetgroup_autoscaler_attachment( target_group_arn, autoscaling_group_name ):
-
-    logger.info("Waiting for attachment of autoscaler " + autoscaling_group_name + " to target_group_arn: " + target_group_arn)
-
-    while True:
-        # Get instances from target group
-        logger.info("Getting target group instances")
-        target_group = elbv2.describe_target_health(
-            TargetGroupArn=target_group_arn
+    # Let the target_in_service waiter poll the health of all of them at once
+    try:
+        elbv2_target_in_service_waiter.wait(
+            TargetGroupArn=target_group_arn,
+            Targets=[{'Id': instance['InstanceId']} for instance in as_instances],
+            WaiterConfig=WAITER_CONFIG
         )
+    except WaiterError as e:
+        logger.info("ERROR: Failed waiting for instances to be healthy in target group '%s': %s", target_group_arn, e)
+        exit(1)
 
-        # Get healthy instance ids from target group
-        logger.info("Getting instance ids from load balancer")
-        instance_health_flat = []
-        for instance in target_group['TargetHealthDescriptions']:
-            if (instance['TargetHealth']['State'] == 'healthy'):
-                instance_health_flat.append(instance['Target']['Id'])
-
-        # Get our healthy instances from our autoscaler
-        logger.info("Getting healthy instances on our autoscaler")
-        autoscaler = get_autoscaling_group( autoscaling_group_name )
-        as_instances = get_autoscaler_healthy_instances( autoscaler )
-
-        successes = 0
-        for instance in as_instances:
-            if instance['InstanceId'] in instance_health_flat:
-                logger.info("SUCCESS - Instance " + instance['InstanceId'] + " is healthy in our target group")
-                successes = successes + 1
-            else:
-                logger.info("FAIL - Instance " + instance['InstanceId'] + " is unhealthy or not present in our target group")
-
-        if successes >= len(as_instances):
-            if int(autoscaler['DesiredCapacity']) == successes:
-                logger.info("We have " + str(successes) + " healthy instances on the target group and on the ASG")
-                break
-            else:
-                logger.info("FAIL - We have " + str(successes) + " healthy instances on the target group but we have desired instances set to " + str(autoscaler['DesiredCapacity']) + " on the ASG")
-        else:
-            logger.info("Found " + str(successes) + " healthy instances on the target group from the ASG " + str(autoscaler['DesiredCapacity']) + " to continue.  Waiting 10 seconds...")
-
-        time.sleep( 10 )
+    logger.info("We have %s healthy instances on the target group and on the ASG", len(as_instances))
 
 
 def wait_for_instances_to_detach_from_loadbalancer( instance_ids, loadbalancer_name ):
     logger.info("Waiting for detachment of instance_ids ")
     logger.info(instance_ids)
-    logger.info("   from load balancer:" + loadbalancer_name)
-
-    while True:
-        loadbalancer = get_load_balancer(loadbalancer_name)
-        lb_instances = get_instance_ids_of_load_balancer(loadbalancer)
-
-        failures = 0
-        for instance in instance_ids:
-            logger.info("  Checking if " + instance + " is attached to load balancer...")
-            if instance in lb_instances:
-                logger.info("    ERROR: Currently attached to the load balancer...")
-                failures = failures + 1
-            else:
-                logger.info("    SUCCESS: Instance is not attached to the load balancer")
+    logger.info("   from load balancer:%s", loadbalancer_name)
 
-        if failures == 0:
-            logger.info("SUCCESS: Done waiting for detachment of instance ids")
-            break
+    # Without any instances the waiter would check every instance attached instead
+    if len(instance_ids) == 0:
+        logger.info("No instances to wait for")
+        return
 
-        logger.info("Waiting for 10 seconds and trying again...")
-        time.sleep( 10 )
-
-    logger.info("DONE waiting for detachment of instances from " + loadbalancer_name)
+    try:
+        elb_instance_deregistered_waiter.wait(
+            LoadBalancerName=loadbalancer_name,
+            Instances=[{'InstanceId': instance_id} for instance_id in instance_ids],
+            WaiterConfig=WAITER_CONFIG
+        )
+    except WaiterError as e:
+        logger.info("ERROR: Failed waiting for detachment of instances from '%s': %s", loadbalancer_name, e)
+        exit(1)
 
+    logger.info("DONE waiting for detachment of instances from %s", loadbalancer_name)
 
 
 def wait_for_instances_to_detach_from_target_group( instance_ids, target_group_arn ):
     logger.info("Waiting for detachment of instance_ids ")
     logger.info(instance_ids)
-    logger.info("   from target group:" + target_group_arn)
+    logger.info("   from target group:%s", target_group_arn)
 
-    while True:
-        logger.info("Getting target group instances")
-        target_group = elbv2.describe_target_health(
-            TargetGroupArn=target_group_arn
+    # Without any instances the waiter would check every instance attached instead
+    if len(instance_ids) == 0:
+        logger.info("No instances to wait for")
+        return
+
+    try:
+        elbv2_target_deregistered_waiter.wait(
+            TargetGroupArn=target_group_arn,
+            Targets=[{'Id': instance_id} for instance_id in instance_ids],
+            WaiterConfig=WAITER_CONFIG
         )
+    except WaiterError as e:
+        logger.info("ERROR: Failed waiting for detachment of instances from '%s': %s", target_group_arn, e)
+        exit(1)
 
-        # Get healthy instance ids from target group
-        logger.info("Getting instance ids from load balancer")
-        instance_health_flat = []
-        for instance in target_group['TargetHealthDescriptions']:
-            instance_health_flat.append(instance['Target']['Id'])
+    logger.info("DONE waiting for detachment of instances from %s", target_group_arn)
 
-        failures = 0
-        for instance in instance_ids:
-            logger.info("  Checking if " + instance + " is attached to target group...")
-            if instance in instance_health_flat:
-                logger.info("    ERROR: Currently attached to the target group...")
-                failures = failures + 1
-            else:
-                logger.info("    SUCCESS: Instance is not attached to the target group")
 
-        if failures == 0:
-            logger.info("SUCCESS: Done waiting for detachment of instance ids")
-            break
 
-        logger.info("Waiting for 10 seconds and trying again...")
-        time.sleep( 10 )
+def flatten_instance_health_array_from_loadbalancer( input_instance_array ):
+    return {instance['InstanceId'] for instance in input_instance_array}
 
-    logger.info("DONE waiting for detachment of instances from " + target_group_arn)
 
 
+def wait_for_complete_loadbalancer_autoscaler_attachment( loadbalancer_name, autoscaler ):
+    logger.info("Waiting for attachment of autoscaler %s to load balancer:%s", autoscaler['AutoScalingGroupName'], loadbalancer_name)
 
-def wait_for_complete_targetgroup_autoscaler_detachment( target_group_arn, autoscaling_group_name ):
+    as_instances = get_healthy_instances_to_wait_for( autoscaler )
 
-    logger.info("Waiting for detachment of autoscaler " + autoscaling_group_name + " from target_group_arn:" + target_group_arn)
+    # Nothing to wait for, and the waiter would check every instance attached instead
+    if len(as_instances) == 0:
+        logger.info("No healthy instances on the ASG to wait for")
+        return
 
-    while True:
-        # Get instances from target group
-        logger.info("Getting target group instances")
-        target_group = elbv2.describe_target_health(
-            TargetGroupArn=target_group_arn
+    # Let the instance_in_service waiter poll the health of all of them at once
+    try:
+        elb_instance_in_service_waiter.wait(
+            LoadBalancerName=loadbalancer_name,
+            Instances=[{'InstanceId': instance['InstanceId']} for instance in as_instances],
+            WaiterConfig=WAITER_CONFIG
         )
+    except WaiterError as e:
+        logger.info("ERROR: Failed waiting for instances to be healthy in load balancer '%s': %s", loadbalancer_name, e)
+        exit(1)
 
-        # Get healthy instance ids from target group
-        logger.info("Getting instance ids from load balancer")
-        instance_health_flat = []
-        for instance in target_group['TargetHealthDescriptions']:
-            instance_health_flat.append(instance['Target']['Id'])
+    logger.info("We have %s healthy instances on the elb and on the ASG", len(as_instances))
 
-        # Get our healthy instances from our autoscaler
-        logger.info("Getting healthy instances on our autoscaler")
-        as_instances = get_autoscaler_healthy_instances( autoscaling_group_name )
-
-        failures = 0
-        for instance in as_instances:
-            if instance['InstanceId'] in instance_health_flat:
-                logger.info("FAIL - Instance " + instance['InstanceId'] + " from our autoscaler is still in our target group")
-                failures = failures + 1
-            else:
-                logger.info("Success - Instance " + instance['InstanceId'] + " from our autoscaler is not in our target group")
-
-        if failures == 0:
-            logger.info("SUCCESS - We have no instances from the autoscaling group on this target group...")
-            break
-        else:
-            logger.info("Found " + str(failures) + " instances still on the target group from the ASG.  Waiting 10 seconds...")
 
-        time.sleep( 10 )
+# Wait for the autoscaler's instances to be healthy on all its load balancers and target groups at once
+def wait_for_complete_autoscaler_attachments( rollout, autoscaler ):
+    tasks = []
 
+    # Wait to have healthy instances on the load balancers
+    if rollout.lb_names:
+        logger.info("Ensuring that these instances are healthy on the load balancer(s)")
+        for name in rollout.lb_names:
+            logger.info("Waiting for all instances to be healthy in %s...", name)
+            tasks.append((wait_for_complete_loadbalancer_autoscaler_attachment, name, autoscaler))
 
+    # Wait to have healthy instances on the target groups
+    if rollout.tg_arns:
+        logger.info("Ensuring that these instances are healthy on the target group(s)")
+        for name in rollout.tg_arns:
+            logger.info("Waiting for all instances to be healthy in %s...", name)
+            tasks.append((wait_for_complete_targetgroup_autoscaler_attachment, name, autoscaler))
 
-def flatten_instance_health_array_from_loadbalancer( input_instance_array ):
-    output = []
-    for instance in input_instance_array:
-        output.append(instance['InstanceId'])
-    return output
+    run_concurrently(tasks)
 
 
+# Wait for instances to be fully detached from all the autoscaler's load balancers and target groups at once
+def wait_for_instances_to_detach_from_autoscaler_attachments( rollout, instance_ids ):
+    tasks = []
 
-def flatten_instance_health_array_from_loadbalancer_only_healthy( input_instance_array ):
-    output = []
-    for instance in input_instance_array:
-        if instance['State'] == 'InService':
-            output.append(instance['InstanceId'])
+    # Wait for proper detachment of the Classic ELBs
+    if rollout.lb_names:
+        logger.info("Ensuring that these instances are fully detached from the load balancer(s)")
+        for name in rollout.lb_names:
+            logger.info("Waiting for complete detachment of old instances from load balancer '%s'...", name)
+            tasks.append((wait_for_instances_to_detach_from_loadbalancer, instance_ids, name))
 
-    return output
+    # Wait for proper detachment of the TGs
+    if rollout.tg_arns:
+        logger.info("Ensuring that these instances are fully detached from the target group(s)")
+        for name in rollout.tg_arns:
+            logger.info("Waiting for complete detachment of old instances from target group '%s'...", name)
+            tasks.append((wait_for_instances_to_detach_from_target_group, instance_ids, name))
 
+    run_concurrently(tasks)
 
-def wait_for_complete_loadbalancer_autoscaler_attachment( loadbalancer_name, autoscaling_group_name ):
-    logger.info("Waiting for attachment of autoscaler " + autoscaling_group_name + " to load balancer:" + loadbalancer_name)
 
-    while True:
-        # Get instances from load balancer
-        logger.info("Getting load balancer")
-        loadbalancer = get_load_balancer(loadbalancer_name)
+# De-register instances from all the autoscaler's load balancers and target groups at once
+def deregister_instances_from_autoscaler_attachments( rollout, instance_ids ):
+    tasks = []
 
-        # Get instance ids from load balancer
-        logger.info("Getting instance ids from load balancer")
-        temptwo = get_instance_ids_of_load_balancer(loadbalancer)
+    if rollout.lb_names:
+        for name in rollout.lb_names:
+            logger.info("De-registering %s from load balancer %s...", instance_ids, name)
+            tasks.append((deregister_instances_from_load_balancer, instance_ids, name))
 
-        # Get their healths (on the ELB)
-        logger.info("Getting instance health on the load balancer")
-        instance_health = elb.describe_instance_health(
-            LoadBalancerName=loadbalancer_name,
-            Instances=loadbalancer['Instances']
-        )
-        instance_health = instance_health['InstanceStates']
+    if rollout.tg_arns:
+        for name in rollout.tg_arns:
+            logger.info("De-registering %s from target group %s...", instance_ids, name)
+            tasks.append((deregister_instances_from_target_group, instance_ids, name))
 
-        # Put it into a flat array so we can check "in" it
-        instance_health_flat = flatten_instance_health_array_from_loadbalancer_only_healthy(instance_health)
+    run_concurrently(tasks)
 
-        # Get our healthy instances from our autoscaler
-        logger.info("Getting healthy instances on our autoscaler")
-        autoscaler = get_autoscaling_group( autoscaling_group_name )
-        as_instances = get_autoscaler_healthy_instances( autoscaler )
 
-        successes = 0
-        for instance in as_instances:
-            if instance['InstanceId'] in instance_health_flat:
-                logger.info("SUCCESS - Instance " + instance['InstanceId'] + " is healthy in our ELB")
-                successes = successes + 1
-            else:
-                logger.info("FAIL - Instance " + instance['InstanceId'] + " is unhealthy or not present in our ELB")
-
-        if successes >= len(as_instances):
-            if int(autoscaler['DesiredCapacity']) == successes:
-                logger.info("We have " + str(successes) + " healthy instances on the elb and on the ASG")
-                break
-            else:
-                logger.info("Found " + str(successes) + " healthy instances on the elb from the ASG " + str(autoscaler['DesiredCapacity']) + " to continue.  Waiting 10 seconds...")
+# Run an external (user supplied) command and return its retval.  If given a timeout the command is
+# killed if it runs for longer than that many seconds
+def run_external_command( command, timeout=None ):
+    # Don't fork a shell just to parse the command if it doesn't use any shell features, and only
+    # if it's a real program (not a shell builtin like exit, cd or source)
+    args, shell = command, True
+    if SHELL_METACHARACTERS.isdisjoint(command):
+        try:
+            split_command = shlex.split(command)
+            if split_command and shutil.which(split_command[0]):
+                args, shell = split_command, False
+        except ValueError:
+            pass
+
+    try:
+        # Commands can print anything, don't let bytes that aren't valid UTF-8 blow up the rollout
+        result = subprocess.run(args, shell=shell, timeout=timeout, capture_output=True, text=True, errors='replace')
+    except subprocess.TimeoutExpired:
+        logger.info("WARNING: Command timed out after %s seconds: %s", timeout, command)
+        return -1
+    except OSError as e:
+        # What a shell would have told us with retval 126
+        logger.info("WARNING: Unable to run command: %s: %s", command, e)
+        return 126
+
+    if result.stdout:
+        logger.info(result.stdout.rstrip())
+    if result.stderr:
+        logger.info(result.stderr.rstrip())
+    if result.returncode != 0:
+        logger.info("WARNING: Command returned retval of %s", result.returncode)
+    return result.returncode
+
+
+# Gets what we string replace into an external command for an instance, prefix is either NEW or OLD
+def get_instance_substitutions( prefix, instance_details ):
+    substitutions = {
+        prefix + '_INSTANCE_ID': instance_details['InstanceId'],
+        prefix + '_INSTANCE_PRIVATE_IP_ADDRESS': instance_details['PrivateIpAddress'],
+    }
+    if 'PublicIpAddress' in instance_details:
+        substitutions[prefix + '_INSTANCE_PUBLIC_IP_ADDRESS'] = instance_details['PublicIpAddress']
+    return substitutions
+
+
+# String replace the instance ID and/or the instance IP address into an external command
+def substitute_into_command( command, substitutions ):
+    return INSTANCE_PLACEHOLDERS.sub(lambda match: substitutions.get(match.group(0), match.group(0)), command)
+
+
+# Build the external health up check command for a new instance, or None if we couldn't figure it out
+def get_new_server_is_up_command( new_instance, instance_details ):
+    try:
+        substitutions = get_instance_substitutions('NEW', instance_details)
+        if 'NEW_INSTANCE_PUBLIC_IP_ADDRESS' in substitutions:
+            logger.info("Found new instance %s with private IP address %s and public IP %s", new_instance['InstanceId'], substitutions['NEW_INSTANCE_PRIVATE_IP_ADDRESS'], substitutions['NEW_INSTANCE_PUBLIC_IP_ADDRESS'])
         else:
-            logger.info("Found " + str(successes) + " healthy instances on the elb from the ASG " + str(autoscaler['DesiredCapacity']) + " to continue.  Waiting 10 seconds...")
+            logger.info("Found new instance %s with private IP address %s and NO public IP address", new_instance['InstanceId'], substitutions['NEW_INSTANCE_PRIVATE_IP_ADDRESS'])
+        return substitute_into_command(options.checkifnewserverisupcommand, substitutions)
+    except Exception:
+        logger.info("WARNING: Failed trying to figure out if new instance is healthy")
+        return None
+
+
+# Run a new instance's external health up check command, returns True if it passed (or if we had no command for it).
+# This is killed after --command-timeout so a hung check can't stall the rollout forever
+def check_if_new_server_is_up( command ):
+    if command is None:
+        return True
+    logger.info("Executing external health shell command: %s", command)
+    return run_external_command(command, options.commandtimeout) == 0
+
+
+# Run one of the server down commands (before or after) for an old instance, these only warn if they fail
+# (run_external_command logs the warning)
+def run_hook( name, template, substitutions ):
+    command = substitute_into_command(template, substitutions)
+    logger.info("Executing %s server down command: %s", name, command)
+    run_external_command(command)
 
-        time.sleep( 10 )
 
 ######################
 # Core application logic
 ######################
 
 # Verify/get our load balancer
-logger.info("Ensuring that \"" + options.autoscaler + "\" is a valid autoscaler in the current region...")
+logger.info('Ensuring that "%s" is a valid autoscaler in the current region...', options.autoscaler)
 autoscaler = get_autoscaling_group(options.autoscaler)
 if autoscaler is False:
-    logger.info("ERROR: '" + options.autoscaler + "' is NOT a valid autoscaler, exiting...")
+    logger.info("ERROR: '%s' is NOT a valid autoscaler, exiting...", options.autoscaler)
     parser.print_usage()
     exit(1)
 
 # Grab some variables we need to use/save/reuse below
-autoscaler_old_max_size = int(autoscaler['MaxSize'])
-autoscaler_old_desired_capacity = int(autoscaler['DesiredCapacity'])
+rollout = RolloutContext(tuple(autoscaler['LoadBalancerNames']), tuple(autoscaler['TargetGroupARNs']))
+autoscaler_old_max_size = autoscaler['MaxSize']
+autoscaler_old_desired_capacity = autoscaler['DesiredCapacity']
+
+# Exit early, before we change anything, if there is nothing to roll out.  This looks at every instance (not just
+# the healthy ones) since anything still launching will need rolling too unless it's already up to date
+instances_to_roll = autoscaler['Instances']
+if options.checkifinstancesneedtobeterminated:
+    instance_ids_up_to_date = {instance['InstanceId'] for instance in get_instances_to_skip(instances_to_roll, autoscaler)}
+    instances_to_roll = [instance for instance in instances_to_roll if instance['InstanceId'] not in instance_ids_up_to_date]
+if len(instances_to_roll) == 0:
+    logger.info("There are no instances that need to be rolled out, exiting...")
+    exit(0)
 
 # Check if we need to increase our max size
 logger.info("Checking if our current desired size is equal to our max size (if so we have to increase max size to deploy)...")
 if autoscaler_old_max_size == autoscaler_old_desired_capacity:
-    logger.info("Updating max size of autoscaler by one from " + str(autoscaler_old_max_size))
+    logger.info("Updating max size of autoscaler by one from %s", autoscaler_old_max_size)
     if update_auto_scaling_group_max_size(options.autoscaler, (autoscaler_old_max_size + 1) ) is True:
         logger.info("Successfully expanded autoscalers max size temporarily for deployment...")
     else:
@@ -713,17 +830,17 @@ if autoscaler_old_max_size == autoscaler_old_desired_capacity:
         exit(1)
 
 # Letting the user know what this autoscaler is attached to...
-if len(autoscaler['LoadBalancerNames']) > 0:
+if rollout.lb_names:
     logger.info("This autoscaler is attached to the following Elastic Load Balancers (ELBs): ")
-    for name in autoscaler['LoadBalancerNames']:
-        logger.info("    ELB: " + name)
+    for name in rollout.lb_names:
+        logger.info("    ELB: %s", name)
 else:
     logger.info("This autoscaler is not attached to any ELBs")
 
-if len(autoscaler['TargetGroupARNs']) > 0:
+if rollout.tg_arns:
     logger.info("This autoscaler is attached to the following Target Groups (for ALBs): ")
-    for name in autoscaler['TargetGroupARNs']:
-        logger.info("    TG: " + name)
+    for name in rollout.tg_arns:
+        logger.info("    TG: %s", name)
 else:
     logger.info("This autoscaler is not attached to any Target Groups")
 
@@ -737,7 +854,7 @@ else:
     succeed = True
     for process in required_processes:
         if process in suspended:
-            logger.info("Error: This autoscaler currently has the required suspended process: " + process)
+            logger.info("Error: This autoscaler currently has the required suspended process: %s", process)
             succeed = False
     if succeed == False:
         exit(1)
@@ -747,31 +864,17 @@ logger.info("Suspending processes so everything can settle on ELB/ALB/TGs: ")
 suspend_new_processes = ['ScheduledActions', 'AlarmNotification', 'AZRebalance']
 suspend_processes( options.autoscaler, suspend_new_processes )
 
-logger.info("Waiting 3 seconds so the autoscaler can settle from the above change...")
-time.sleep(3)
+# Wait to have healthy == desired instances on the autoscaler
+logger.info("Ensuring that we have the right number of instances on the autoscaler")
+wait_for_autoscaler_to_have_healthy_desired_instances(options.autoscaler)
 
 # Get our autoscaler info again... just-incase something changed on it before doing the below health-check logic...
+# This one description is shared by all of the load balancer/target group checks below
 autoscaler = get_autoscaling_group(options.autoscaler)
 
-# Wait to have healthy == desired instances on the autoscaler
-logger.info("Ensuring that we have the right number of instances on the autoscaler")
-wait_for_autoscaler_to_have_healthy_desired_instances(autoscaler)
-
 # Only if we want to not force-deploy do we check if the instances get health on their respective load balancers/target groups
 if (not options.force):
-    # Wait to have healthy instances on the load balancers
-    if len(autoscaler['LoadBalancerNames']) > 0:
-        logger.info("Ensuring that these instances are healthy on the load balancer(s)")
-        for name in autoscaler['LoadBalancerNames']:
-            logger.info("Waiting for all instances to be healthy in " + name + "...")
-            wait_for_complete_loadbalancer_autoscaler_attachment( name, options.autoscaler )
-
-    # Wait to have healthy instances on the target groups
-    if len(autoscaler['TargetGroupARNs']) > 0:
-        logger.info("Ensuring that these instances are healthy on the target group(s)")
-        for name in autoscaler['TargetGroupARNs']:
-            logger.info("Waiting for all instances to be healthy in " + name + "...")
-            wait_for_complete_targetgroup_autoscaler_attachment( name, options.autoscaler )
+    wait_for_complete_autoscaler_attachments( rollout, autoscaler )
 
 logger.info("====================================================")
 logger.info("Performing rollout...")
@@ -786,181 +889,123 @@ if options.checkifinstancesneedtobeterminated:
     logger.info("INFO: Checking if there are instances to skip")
     instances_to_skip = get_instances_to_skip(instances_to_kill, autoscaler)
     for instance in instances_to_skip:
-        logger.info("Skiping instance " + instance['InstanceId'])
-        instances_to_kill.remove(instance)
+        logger.info("Skiping instance %s", instance['InstanceId'])
+    instance_ids_to_skip = {instance['InstanceId'] for instance in instances_to_skip}
+    instances_to_kill = [instance for instance in instances_to_kill if instance['InstanceId'] not in instance_ids_to_skip]
 
 # Keep a tally of current instances...
 current_instance_list = get_autoscaler_healthy_instances(autoscaler)
 
 def find_aws_instances_in_first_list_but_not_in_second( array_one, array_two ):
-    output = []
-    for instance_array_one in array_one:
-        # logger.info("Found " + instance_array_one['InstanceId'] + " in array one...")
-        found = False
-        for instance_array_two in array_two:
-            if instance_array_two['InstanceId'] == instance_array_one['InstanceId']:
-                # logger.info("Found " + instance_array_two['InstanceId'] + " in array two also")
-                found = True
-
-        if (not found):
-            # logger.info("Did not find instance in array two, returning this...")
-            output.append(instance_array_one)
-
-    return output
+    known_instance_ids = {instance['InstanceId'] for instance in array_two}
+    return [instance for instance in array_one if instance['InstanceId'] not in known_instance_ids]
+
+# Gets a fresh copy of the autoscaler (uncached, we are waiting for it to change) and the healthy
+# instances on it we don't already know about, or None if there aren't any yet
+def get_new_autoscaler_instances( autoscaling_group_name, known_instances ):
+    autoscaler_description = describe_autoscaling_group(autoscaling_group_name)
+    new_instances = find_aws_instances_in_first_list_but_not_in_second(get_autoscaler_healthy_instances(autoscaler_description), known_instances)
+    if len(new_instances) == 0:
+        return None
+    return autoscaler_description, new_instances
+
+# Gets a fresh copy of the autoscaler once it shows our new desired capacity, or None until it does
+def get_autoscaler_with_desired_capacity( autoscaling_group_name, desired_capacity ):
+    autoscaler_description = describe_autoscaling_group(autoscaling_group_name)
+    if autoscaler_description['DesiredCapacity'] != desired_capacity:
+        return None
+    return autoscaler_description
+
+# Gets a fresh copy of the autoscaler once it no longer counts an instance (we terminated) as healthy, or None until it does
+def get_autoscaler_without_healthy_instance( autoscaling_group_name, instance_id ):
+    autoscaler_description = describe_autoscaling_group(autoscaling_group_name)
+    if instance_id in {instance['InstanceId'] for instance in get_autoscaler_healthy_instances(autoscaler_description)}:
+        return None
+    return autoscaler_description
 
 # Increase our desired size by one so a new instance will be started (usually from a new launch configuration)
 # Don't increase desired capacity if there is no instance to kill
 if len(instances_to_kill) > 0:
-    logger.info("Increasing desired capacity by one from " + str(autoscaler['DesiredCapacity']) + " to " + str(autoscaler['DesiredCapacity'] + 1))
+    logger.info("Increasing desired capacity by one from %s to %s", autoscaler['DesiredCapacity'], autoscaler['DesiredCapacity'] + 1)
     set_desired_capacity( options.autoscaler, autoscaler['DesiredCapacity'] + 1 )
+    # Make sure the autoscaler shows the change before we start waiting on it to have healthy == desired instances
+    poll(
+        lambda: get_autoscaler_with_desired_capacity(options.autoscaler, autoscaler['DesiredCapacity'] + 1),
+        autoscaling_backoff(),
+        "The autoscaler doesn't show our new desired capacity yet"
+    )
 
 downscaled = False
 
+# Our after server down commands run one at a time, in order, but overlapping the next instance's rollout (if run in the background)
+after_server_down_commands = ThreadPoolExecutor(max_workers=1)
+after_server_down_futures = []
+
+# Describe all the instances we are about to kill in one go, rather than once per instance in the loop below
+old_instances_details = describe_instances_bulk([instance['InstanceId'] for instance in instances_to_kill])
 
-for i, instance in enumerate(instances_to_kill):
 
-    # Sleep a little bit every loop, just incase...
-    logger.info("Sleeping for 3 seconds so the autoscaler can catch-up...")
-    time.sleep(3)
+for i, instance in enumerate(instances_to_kill):
 
-    # This is used in the external "down" helper below, but we need to do this here before we start shutting down this instance
-    old_instance_details = describe_instance(instance['InstanceId'])
+    # This is used in the external "down" helper below, described up front before we start shutting down any instance
+    old_instance_details = old_instances_details.get(instance['InstanceId'])
+    if (options.runbeforeserverdowncommand or options.runafterserverdowncommand):
+        old_instance_substitutions = get_instance_substitutions('OLD', old_instance_details)
 
     # Wait to have healthy == desired instances on the autoscaler
     logger.info("Ensuring that we have the right number of instances on the autoscaler")
     wait_for_autoscaler_to_have_healthy_desired_instances( options.autoscaler )
 
-    # Wait for new instances to spin up...
-    while True:
-        logger.info("Waiting for new instance(s) to spin up...")
-        # Lets figure out what the new instance ID(s) are here...
-        new_current_instance_list = get_autoscaler_healthy_instances(options.autoscaler)
-        new_instances = find_aws_instances_in_first_list_but_not_in_second(new_current_instance_list, current_instance_list)
-        if len(new_instances) == 0:
-            logger.info("There are no new instances yet... waiting 10 seconds...")
-            time.sleep(10)
-        else:
-            break;
+    # Wait for new instances to spin up, and figure out what the new instance ID(s) are.  This description
+    # of the autoscaler is also shared by all of the load balancer/target group checks below
+    logger.info("Waiting for new instance(s) to spin up...")
+    autoscaler_description, new_instances = poll(
+        lambda: get_new_autoscaler_instances(options.autoscaler, current_instance_list),
+        autoscaling_backoff(),
+        "There are no new instances yet"
+    )
 
     # Only if we instructed that we want to not skip the health checks on the way up
     if (not options.skip):
-        # Wait to have healthy instances on the load balancers
-        if len(autoscaler['LoadBalancerNames']) > 0:
-            logger.info("Ensuring that these instances are healthy on the load balancer(s)")
-            for name in autoscaler['LoadBalancerNames']:
-                logger.info("Waiting for all instances to be healthy in " + name + "...")
-                wait_for_complete_loadbalancer_autoscaler_attachment( name, options.autoscaler )
-
-        # Wait to have healthy instances on the target groups
-        if len(autoscaler['TargetGroupARNs']) > 0:
-            logger.info("Ensuring that these instances are healthy on the target group(s)")
-            for name in autoscaler['TargetGroupARNs']:
-                logger.info("Waiting for all instances to be healthy in " + name + "...")
-                wait_for_complete_targetgroup_autoscaler_attachment( name, options.autoscaler )
+        wait_for_complete_autoscaler_attachments( rollout, autoscaler_description )
 
     # Wait for instance to get healthy (custom handler) if desired...
     if (options.checkifnewserverisupcommand):
         logger.info("Running external health up check upon request...")
-        while True:
-            succeeded_health_up_check = True
-            # String replacing the instance ID and/or the instance IP address into the external script
-            for new_instance in new_instances:
-                try:
-                    instance_details = describe_instance(new_instance['InstanceId'])
-                    private_ip_address = instance_details['PrivateIpAddress']
-                    if 'PublicIpAddress' in instance_details:
-                        public_ip_address = instance_details['PublicIpAddress']
-                        logger.info("Found new instance " + new_instance['InstanceId'] + " with private IP address " + private_ip_address + " and public IP " + public_ip_address)
-                    else:
-                        logger.info("Found new instance " + new_instance['InstanceId'] + " with private IP address " + private_ip_address + " and NO public IP address")
-
-                    tmpcommand = str(options.checkifnewserverisupcommand)
-                    tmpcommand = tmpcommand.replace('NEW_INSTANCE_ID',new_instance['InstanceId'])
-                    tmpcommand = tmpcommand.replace('NEW_INSTANCE_PRIVATE_IP_ADDRESS', private_ip_address)
-                    if 'PublicIpAddress' in instance_details:
-                        tmpcommand = tmpcommand.replace('NEW_INSTANCE_PUBLIC_IP_ADDRESS', public_ip_address)
-                    logger.info("Executing external health shell command: " + tmpcommand)
-                    retval = call(tmpcommand, shell=True)
-                    # print "Got return value " + str(retval)
-                    if (retval != 0):
-                        succeeded_health_up_check = False
-                except:
-                    logger.info("WARNING: Failed trying to figure out if new instance is healthy")
-
-            if succeeded_health_up_check:
-                logger.info("SUCCESS: We are done checking instances with a custom command")
-                break
-            else:
-                logger.info("FAIL: We are done checking instances with a custom command, but (at least one) has failed, re-trying in 10 seconds...")
-            time.sleep(10)
-
-    logger.info("Should de-register instance " + instance['InstanceId'] + " from ALB/ELBs if attached...")
-
-    # If we have load balancers...
-    if len(autoscaler['LoadBalancerNames']) > 0:
-        for name in autoscaler['LoadBalancerNames']:
-            logger.info("De-registering " + instance['InstanceId'] + " from load balancer " + name + "...")
-            deregister_instance_from_load_balancer( instance['InstanceId'], name )
-
-    # If we have target groups...
-    if len(autoscaler['TargetGroupARNs']) > 0:
-        for name in autoscaler['TargetGroupARNs']:
-            logger.info("De-registering " + instance['InstanceId'] + " from target group " + name + "...")
-            deregister_instance_from_target_group( instance['InstanceId'], name )
-
-    # If we have load balancers...
-    if len(autoscaler['LoadBalancerNames']) > 0:
-        for name in autoscaler['LoadBalancerNames']:
-            while True:
-                instance_ids = get_instance_ids_of_load_balancer( name )
-                logger.info("Got instance ids...")
-                logger.info(instance_ids)
-                if instance['InstanceId'] in instance_ids:
-                    logger.info("Instance ID is still in load balancer, sleeping for 10 seconds...")
-                    time.sleep(10)
-                else:
-                    logger.info("Instance ID is removed from load balancer, continuing...")
-                    break
-
-    # If we have target groups...
-    if len(autoscaler['TargetGroupARNs']) > 0:
-        for name in autoscaler['TargetGroupARNs']:
-            while True:
-                instance_ids = get_instance_ids_of_target_group( name )
-                if instance['InstanceId'] in instance_ids:
-                    logger.info("Instance ID is still in target group, sleeping for 10 seconds...")
-                    time.sleep(10)
-                else:
-                    logger.info("Instance ID is removed from target group, continuing...")
-                    break
+        # Describe all the new instances in one go and build their commands once, none of this changes in-between retries
+        new_instances_details = describe_instances_bulk([new_instance['InstanceId'] for new_instance in new_instances])
+        up_commands = [get_new_server_is_up_command(new_instance, new_instances_details.get(new_instance['InstanceId'])) for new_instance in new_instances]
+        # Check them all at once, every time
+        if not poll(
+            lambda: all(run_concurrently([(check_if_new_server_is_up, command) for command in up_commands])),
+            backoff(options.pollinterval, options.maxpollinterval),
+            "FAIL: We are done checking instances with a custom command, but (at least one) has failed",
+            EXTERNAL_HEALTH_CHECK_MAX_SECONDS
+        ):
+            logger.info("ERROR: The custom command has not succeeded for (at least one) new instance in %s seconds, giving up", EXTERNAL_HEALTH_CHECK_MAX_SECONDS)
+            exit(1)
+        logger.info("SUCCESS: We are done checking instances with a custom command")
+
+    logger.info("Should de-register instance %s from ALB/ELBs if attached...", instance['InstanceId'])
+
+    # De-register it from all of them at once
+    deregister_instances_from_autoscaler_attachments( rollout, [instance['InstanceId']] )
+
+    # Wait for it to finish draining out of all of them at once (the waiters poll for us)
+    wait_for_instances_to_detach_from_autoscaler_attachments( rollout, [instance['InstanceId']] )
 
     # Run a command on server going down, if desired...
     if (options.runbeforeserverdowncommand):
         logger.info("Running external server down command...")
-        # String replacing the instance ID and/or the instance IP address into the external script
-        old_private_ip_address = old_instance_details['PrivateIpAddress']
-        if 'PublicIpAddress' in old_instance_details:
-            old_public_ip_address = old_instance_details['PublicIpAddress']
-
-        tmpcommand = str(options.runbeforeserverdowncommand)
-        tmpcommand = tmpcommand.replace('OLD_INSTANCE_ID',old_instance_details['InstanceId'])
-        tmpcommand = tmpcommand.replace('OLD_INSTANCE_PRIVATE_IP_ADDRESS', old_private_ip_address)
-        if 'PublicIpAddress' in old_instance_details:
-            tmpcommand = tmpcommand.replace('OLD_INSTANCE_PUBLIC_IP_ADDRESS', old_public_ip_address)
-        logger.info("Executing before server down command: " + tmpcommand)
-        retval = call(tmpcommand, shell=True)
-        # print "Got return value " + str(retval)
-        if (retval != 0):
-            logger.info("WARNING: Server down command returned retval of " + str(retval))
+        run_hook("before", options.runbeforeserverdowncommand, old_instance_substitutions)
 
     # If the user specified they want to wait
     if (options.waitforseconds > 0):
-        logger.info("User requested to wait for {0} before terminating instances...".format(options.waitforseconds))
+        logger.info("User requested to wait for %s before terminating instances...", options.waitforseconds)
         time.sleep(options.waitforseconds)
 
     # Re-get our current instance list, for the custom health check script
-    time.sleep(2)
-    current_instance_list = get_autoscaler_healthy_instances(options.autoscaler)
+    current_instance_list = get_autoscaler_healthy_instances(get_autoscaling_group(options.autoscaler))
 
     # Now terminate our instance in our autoscaling group...
     # If this is our last time in this loop then we want to decrement the capacity along with it
@@ -971,46 +1016,39 @@ for i, instance in enumerate(instances_to_kill):
     else:
         terminate_instance_in_auto_scaling_group( instance['InstanceId'], options.autoscaler )
 
-    # Run a command on server going down, if desired...
+    # Make sure the autoscaler shows it is gone before we (and the next loop) carry on
+    poll(
+        lambda: get_autoscaler_without_healthy_instance(options.autoscaler, instance['InstanceId']),
+        autoscaling_backoff(),
+        "The autoscaler still counts the terminated instance as healthy"
+    )
+
+    # Run a command on server going down, if desired, optionally in the background while the replacement instance spins up
     if (options.runafterserverdowncommand):
-        logger.info("Running external server down command after...")
-        time.sleep(2)
-        # String replacing the instance ID and/or the instance IP address into the external script
-        old_private_ip_address = old_instance_details['PrivateIpAddress']
-        if 'PublicIpAddress' in old_instance_details:
-            old_public_ip_address = old_instance_details['PublicIpAddress']
-
-        tmpcommand = str(options.runafterserverdowncommand)
-        tmpcommand = tmpcommand.replace('OLD_INSTANCE_ID',old_instance_details['InstanceId'])
-        tmpcommand = tmpcommand.replace('OLD_INSTANCE_PRIVATE_IP_ADDRESS', old_private_ip_address)
-        if 'PublicIpAddress' in old_instance_details:
-            tmpcommand = tmpcommand.replace('OLD_INSTANCE_PUBLIC_IP_ADDRESS', old_public_ip_address)
-        logger.info("Executing after server down command: " + tmpcommand)
-        retval = call(tmpcommand, shell=True)
-        # print "Got return value " + str(retval)
-        if (retval != 0):
-            logger.info("WARNING: Server down command returned retval of " + str(retval))
+        if (options.runafterserverdowncommandinbackground):
+            logger.info("Running external server down command after (in the background)...")
+            after_server_down_futures.append(after_server_down_commands.submit(run_hook, "after", options.runafterserverdowncommand, old_instance_substitutions))
+        else:
+            logger.info("Running external server down command after...")
+            run_hook("after", options.runafterserverdowncommand, old_instance_substitutions)
+
+# Let any after server down commands still running finish, and report any that blew up instead of just warning
+after_server_down_commands.shutdown(wait=True)
+for future in after_server_down_futures:
+    try:
+        future.result()
+    except Exception as e:
+        logger.info("WARNING: Failed running an after server down command: %s", e)
 
 instances_to_kill_flat = flatten_instance_health_array_from_loadbalancer( instances_to_kill )
 
-# Before exiting, just incase lets wait for proper detachment of the Classic ELBs (wait for: idle timeout / connection draining to finish)
+# Before exiting, just incase lets wait for proper detachment of the ELBs/TGs (wait for: idle timeout / connection draining to finish)
 if (not options.force):
-    if len(autoscaler['LoadBalancerNames']) > 0:
-        logger.info("Ensuring that these instances are fully detached from the load balancer(s)")
-        for name in autoscaler['LoadBalancerNames']:
-            logger.info("Waiting for complete detachment of old instances from load balancer '" + name + "'...")
-            wait_for_instances_to_detach_from_loadbalancer( instances_to_kill_flat, name )
-
-    # Before exiting, just incase lets wait for proper detachment of the TGs (wait for: idle timeout / connection draining to finish)
-    if len(autoscaler['TargetGroupARNs']) > 0:
-        logger.info("Ensuring that these instances are fully detached from the target group(s)")
-        for name in autoscaler['TargetGroupARNs']:
-            logger.info("Waiting for complete detachment of old instances from target group '" + name + "'...")
-            wait_for_instances_to_detach_from_target_group( instances_to_kill_flat, name )
+    wait_for_instances_to_detach_from_autoscaler_attachments( rollout, instances_to_kill_flat )
 
 # This should never happen unless the above for loop breaks out unexpectedly
 if downscaled == False:
-    logger.info("Manually decreasing desired capacity back to " + str(autoscaler_old_desired_capacity))
+    logger.info("Manually decreasing desired capacity back to %s", autoscaler_old_desired_capacity)
     set_desired_capacity( options.autoscaler, autoscaler_old_desired_capacity )
 
 # Resume our processes...
@@ -1024,7 +1062,7 @@ else:
 # Check if we need to decrease our max size back to what it was
 logger.info("Checking if we changed our max size, if so, shrink it again...")
 if autoscaler_old_max_size == autoscaler_old_desired_capacity:
-    logger.info("Updating max size of autoscaler down one to " + str(autoscaler_old_max_size))
+    logger.info("Updating max size of autoscaler down one to %s", autoscaler_old_max_size)
     if update_auto_scaling_group_max_size(options.autoscaler, autoscaler_old_max_size ) is True:
         logger.info("Successfully shrunk autoscalers max size back to its old value")
     else: